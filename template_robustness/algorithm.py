@@ -2,8 +2,9 @@
 from dataclasses import dataclass, field
 from enum import Enum
 from typing import Self
+import functools
 import itertools
-import networkx as nx
+import multiprocessing
 from tqdm import tqdm
 
 
@@ -15,10 +16,18 @@ class IsolationLevel(Enum):
 
 
 class Conn(Enum):
-    """Three possible connectedness options: connected to o1, connected to p1, or not connected."""
+    """
+    Three possible connectedness options: connected to o1, connected to p1, or not connected.
+    The values are distinct bits, so that a set of options can be represented as a bitmask.
+    """
     O = 1
     P = 2
-    N = 3
+    N = 4
+
+
+CONN_O = Conn.O.value
+CONN_P = Conn.P.value
+CONN_N = Conn.N.value
 
 
 class InOut(Enum):
@@ -27,28 +36,71 @@ class InOut(Enum):
     OUT = 2
 
 
-@dataclass(frozen=True, eq=True)
+# Interned ids of attribute names, relation names, operations and template names.
+# Every attribute id is used as a bit position, so that sets of attributes are bitmasks.
+_ATTRIBUTE_IDS: dict[str, int] = {}
+_RELATION_IDS: dict[str, int] = {}
+_OPERATION_IDS: dict[tuple[str, str, frozenset[str], frozenset[str]], int] = {}
+_TEMPLATE_IDS: dict[str, int] = {}
+
+
+def _intern(ids: dict, key) -> int:
+    """Returns the id of key, assigning the next free id to keys not seen before."""
+    return ids.setdefault(key, len(ids))
+
+
+def _attribute_mask(attributes: frozenset[str]) -> int:
+    """Returns the bitmask representing the given set of attributes."""
+    mask = 0
+    for attribute in attributes:
+        mask |= 1 << _intern(_ATTRIBUTE_IDS, attribute)
+    return mask
+
+
+@dataclass(frozen=True, eq=False)
 class Operation:
-    """Dataclass representing an operation."""
+    """
+    Dataclass representing an operation.
+    The relation and the readset and writeset are also stored as an interned id and
+    attribute bitmasks, used by the conflict checks. Equal operations share the same oid,
+    which is used for hashing and equality.
+    """
     variable: str
     relation: str
     readset: frozenset[str] = frozenset()
     writeset: frozenset[str] = frozenset()
+    relation_id: int = field(init=False, repr=False, compare=False)
+    read_mask: int = field(init=False, repr=False, compare=False)
+    write_mask: int = field(init=False, repr=False, compare=False)
+    oid: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "relation_id", _intern(_RELATION_IDS, self.relation))
+        object.__setattr__(self, "oid", _intern(
+            _OPERATION_IDS, (self.variable, self.relation, self.readset, self.writeset)))
+        object.__setattr__(self, "read_mask", _attribute_mask(self.readset))
+        object.__setattr__(self, "write_mask", _attribute_mask(self.writeset))
+
+    def __hash__(self) -> int:
+        return self.oid
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Operation) and self.oid == other.oid
 
     def is_rw_conflicting(self, other: Self) -> bool:
         """True iff this operation is rw-conflicting with the other operation."""
-        return self.relation == other.relation and \
-            len(self.readset.intersection(other.writeset)) > 0
+        return self.relation_id == other.relation_id and \
+            (self.read_mask & other.write_mask) != 0
 
     def is_wr_conflicting(self, other: Self) -> bool:
         """True iff this operation is wr-conflicting with the other operation."""
-        return self.relation == other.relation and \
-            len(self.writeset.intersection(other.readset)) > 0
+        return self.relation_id == other.relation_id and \
+            (self.write_mask & other.read_mask) != 0
 
     def is_ww_conflicting(self, other: Self) -> bool:
         """True iff this operation is ww-conflicting with the other operation."""
-        return self.relation == other.relation and \
-            len(self.writeset.intersection(other.writeset)) > 0
+        return self.relation_id == other.relation_id and \
+            (self.write_mask & other.write_mask) != 0
 
     def is_conflicting(self, other: Self) -> bool:
         """True iff this operation is conflicting with the other operation."""
@@ -83,13 +135,72 @@ class Allocation:
         return result
 
 
-@dataclass(frozen=True, eq=True)
+class ConflictTable:
+    """
+    Pairwise conflicts between all operations of a template set, computed once.
+    The tables are indexed by the oid of the operations.
+    """
+
+    def __init__(self, template_set: TemplateSet):
+        ops = list(dict.fromkeys(o for t in template_set.templates for o in t.operations))
+        size = max(o.oid for o in ops) + 1 if ops else 0
+        self.rw = [[False] * size for _ in range(size)]
+        self.wr = [[False] * size for _ in range(size)]
+        self.ww = [[False] * size for _ in range(size)]
+        self.any = [[False] * size for _ in range(size)]
+        for o, p in itertools.product(ops, repeat=2):
+            self.rw[o.oid][p.oid] = o.is_rw_conflicting(p)
+            self.wr[o.oid][p.oid] = o.is_wr_conflicting(p)
+            self.ww[o.oid][p.oid] = o.is_ww_conflicting(p)
+            self.any[o.oid][p.oid] = o.is_conflicting(p)
+
+        # Inverted indexes: for every operation o, the (template, operation) pairs
+        # p with o rw-conflicting with p, resp. p conflicting with o
+        template_ops = list(dict.fromkeys((t, p) for t in template_set.templates for p in t.operations))
+        self.rw_partners: dict[Operation, list[tuple[Template, Operation]]] = {
+            o: [(t, p) for t, p in template_ops if self.is_rw_conflicting(o, p)] for o in ops}
+        self.conflicting_partners: dict[Operation, list[tuple[Template, Operation]]] = {
+            o: [(t, p) for t, p in template_ops if self.is_conflicting(p, o)] for o in ops}
+
+    def is_rw_conflicting(self, o: Operation, p: Operation) -> bool:
+        """True iff operation o is rw-conflicting with operation p."""
+        return self.rw[o.oid][p.oid]
+
+    def is_wr_conflicting(self, o: Operation, p: Operation) -> bool:
+        """True iff operation o is wr-conflicting with operation p."""
+        return self.wr[o.oid][p.oid]
+
+    def is_ww_conflicting(self, o: Operation, p: Operation) -> bool:
+        """True iff operation o is ww-conflicting with operation p."""
+        return self.ww[o.oid][p.oid]
+
+    def is_conflicting(self, o: Operation, p: Operation) -> bool:
+        """True iff operation o is conflicting with operation p."""
+        return self.any[o.oid][p.oid]
+
+
+@dataclass(frozen=True, eq=False)
 class GraphNode:
-    """Dataclass representing a node in the pt-conflict-graph."""
+    """
+    Dataclass representing a node in the pt-conflict-graph.
+    The ids of its template and operation, its conn and k are packed into the single integer nid,
+    which is used for hashing and equality.
+    """
     template: Template
     operation: Operation
     conn: Conn
     k: InOut
+    nid: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "nid", _intern(_TEMPLATE_IDS, self.template.name) << 40 |
+                           self.operation.oid << 4 | self.conn.value << 1 | (self.k == InOut.OUT))
+
+    def __hash__(self) -> int:
+        return self.nid
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, GraphNode) and self.nid == other.nid
 
 
 def is_node_valid(node: GraphNode, o1: Operation, p1: Operation, t1: Template) -> bool:
@@ -108,62 +219,171 @@ def is_node_valid(node: GraphNode, o1: Operation, p1: Operation, t1: Template) -
     return True
 
 
-def is_edge_valid(node1: GraphNode, node2: GraphNode, h: int) -> bool:
-    """Check whether an edge is valid in the pt-conflict-graph."""
-    # Conflict between two templates
-    if node1.k == InOut.OUT and node2.k == InOut.IN:
-        # Condition (3)
-        if node1.conn == node2.conn and \
-                node1.operation.is_conflicting(node2.operation):
-            return True
-
-    # pass info within template
-    elif node1.k == InOut.IN and node2.k == InOut.OUT and node1.template == node2.template:
-        # Condition (4)
-        if node1.operation.variable != node2.operation.variable and \
-            (node1.conn, node2.conn) in [(Conn.O, Conn.P), (Conn.O, Conn.N),
-                                         (Conn.N, Conn.N), (Conn.N, Conn.P)]:
-            return True
+def is_inner_edge_valid(node1: GraphNode, node2: GraphNode, h: int) -> bool:
+    """
+    Check whether an edge within a template is valid in the pt-conflict-graph,
+    i.e. Conditions (4), (5) and (6) for an IN node1 and an OUT node2 of the same template.
+    Edges between templates, Condition (3), are added by pt_conflict_graph itself.
+    """
+    # Condition (4)
+    if node1.operation.variable != node2.operation.variable and \
+        (node1.conn, node2.conn) in [(Conn.O, Conn.P), (Conn.O, Conn.N),
+                                     (Conn.N, Conn.N), (Conn.N, Conn.P)]:
+        return True
 
-        # Condition (5)
-        if node1.operation.variable == node2.operation.variable and \
-                node1.conn == node2.conn:
-            return True
+    # Condition (5)
+    if node1.operation.variable == node2.operation.variable and \
+            node1.conn == node2.conn:
+        return True
 
-        # Condition (6)
-        if node1.operation.variable == node2.operation.variable and \
-                node1.conn == Conn.O and node2.conn == Conn.P and \
-                h == 1:
-            return True
+    # Condition (6)
+    if node1.operation.variable == node2.operation.variable and \
+            node1.conn == Conn.O and node2.conn == Conn.P and \
+            h == 1:
+        return True
 
     return False
 
 
+@dataclass
+class PtConflictGraph:
+    """
+    Dataclass representing a pt-conflict-graph.
+    The nodes are numbered by their position in nodes, and adj holds the neighbours of every node.
+    """
+    nodes: list[GraphNode] = field(default_factory=list)
+    adj: list[list[int]] = field(default_factory=list)
+
+    def add_node(self, node: GraphNode) -> int:
+        """Adds node to the graph and returns its number."""
+        self.nodes.append(node)
+        self.adj.append([])
+        return len(self.nodes) - 1
+
+    def add_edge(self, i: int, j: int):
+        """Adds the undirected edge between the nodes numbered i and j."""
+        self.adj[i].append(j)
+        self.adj[j].append(i)
+
+
 def pt_conflict_graph(o1: Operation, p1: Operation, t1: Template,
-                      h: int, template_set: TemplateSet) -> nx.Graph:
+                      h: int, template_set: TemplateSet) -> PtConflictGraph:
     """Construct the pt-conflict-graph(o1, p1, t1, h, template_set)."""
-    graph = nx.Graph()
-
-    # Create nodes
+    graph = PtConflictGraph()
+
+    # Create nodes, bucketed by the keys edges can exist between
+    numbers: dict[GraphNode, int] = {}
+    by_conn: dict[tuple[Conn, InOut], list[int]] = {}
+    by_template: dict[tuple[Template, InOut], list[int]] = {}
+    # Validity of a node only depends on its template, the variable of its operation and its conn
+    valid_conns: dict[tuple[Template, str], list[Conn]] = {}
     for t in template_set.templates:
         for o in t.operations:
-            for c in Conn:
+            if (t, o.variable) not in valid_conns:
+                valid_conns[t, o.variable] = [c for c in Conn
+                                              if is_node_valid(GraphNode(t, o, c, InOut.IN), o1, p1, t1)]
+            for c in valid_conns[t, o.variable]:
                 for k in InOut:
                     node = GraphNode(t, o, c, k)
-                    if is_node_valid(node, o1, p1, t1):
-                        graph.add_node(node)
-
-    # Add edges
-    for node1, node2 in itertools.product(graph.nodes, repeat=2):
-        if is_edge_valid(node1, node2, h):
-            graph.add_edge(node1, node2)
+                    if node in numbers:
+                        continue
+                    i = numbers[node] = graph.add_node(node)
+                    by_conn.setdefault((c, k), []).append(i)
+                    by_template.setdefault((t, k), []).append(i)
+
+    # Add edges between templates, Condition (3)
+    nodes = graph.nodes
+    for c in Conn:
+        for i, j in itertools.product(by_conn.get((c, InOut.OUT), ()),
+                                      by_conn.get((c, InOut.IN), ())):
+            if nodes[i].operation.is_conflicting(nodes[j].operation):
+                graph.add_edge(i, j)
+
+    # Add edges within templates, Conditions (4), (5) and (6)
+    for t in template_set.templates:
+        for i, j in itertools.product(by_template.get((t, InOut.IN), ()),
+                                      by_template.get((t, InOut.OUT), ())):
+            if is_inner_edge_valid(nodes[i], nodes[j], h):
+                graph.add_edge(i, j)
 
     return graph
 
 
+class Reachability:
+    """
+    Reflexive transitive closure of a pt-conflict-graph.
+    The graph is undirected, so a node reaches exactly the nodes of its connected component,
+    which are found by a depth-first search from every node not visited yet.
+    The components are numbered, and for every (operation id, conn) the components are kept
+    as a bitmask in which an IN-node, resp. OUT-node, with that conn and an operation
+    conflicting with that operation occurs.
+    """
+
+    def __init__(self, graph: PtConflictGraph, conflicts: ConflictTable):
+        self.in_src: dict[tuple[int, Conn], int] = {}
+        self.out_dst: dict[tuple[int, Conn], int] = {}
+        visited = [False] * len(graph.nodes)
+        components = 0
+        for source, node in enumerate(graph.nodes):
+            if visited[source]:
+                continue
+            visited[source] = True
+            component = [node]
+            stack = [source]
+            while stack:
+                for neighbour in graph.adj[stack.pop()]:
+                    if not visited[neighbour]:
+                        visited[neighbour] = True
+                        component.append(graph.nodes[neighbour])
+                        stack.append(neighbour)
+
+            bit = 1 << components
+            components += 1
+            for node in component:
+                index = self.in_src if node.k == InOut.IN else self.out_dst
+                for oid, conflicting in enumerate(conflicts.any[node.operation.oid]):
+                    if conflicting:
+                        index[oid, node.conn] = index.get((oid, node.conn), 0) | bit
+
+    def connects(self, o2: Operation, co2: Conn, pn: Operation, cpn: Conn) -> bool:
+        """
+        True iff an IN-node with connectedness co2 and an operation conflicting with o2
+        reaches an OUT-node with connectedness cpn and an operation conflicting with pn.
+        """
+        return (self.in_src.get((o2.oid, co2), 0) & self.out_dst.get((pn.oid, cpn), 0)) != 0
+
+
+def _template_set_key(template_set: TemplateSet) -> frozenset[tuple[Template, tuple[Operation, ...]]]:
+    """
+    Hashable key identifying a template set.
+    Templates only compare by name, so their operations are included as well.
+    """
+    return frozenset((t, tuple(t.operations)) for t in template_set.templates)
+
+
+@functools.lru_cache(maxsize=None)
+def _conflict_table(key: frozenset[tuple[Template, tuple[Operation, ...]]]) -> ConflictTable:
+    """The ConflictTable of the template set identified by key, computed once."""
+    return ConflictTable(TemplateSet({t for t, _ in key}))
+
+
+@functools.lru_cache(maxsize=None)
+def _pt_closure(o1: Operation, p1: Operation, t1: Template, h: int,
+                key: frozenset[tuple[Template, tuple[Operation, ...]]]) -> Reachability:
+    """
+    The transitive closure of pt-conflict-graph(o1, p1, t1, h, template_set),
+    with template_set identified by key.
+    The graph does not depend on the allocation, so the closure is shared
+    between all robustness tests over the same template set.
+    """
+    template_set = TemplateSet({t for t, _ in key})
+    return Reachability(pt_conflict_graph(o1, p1, t1, h, template_set),
+                        _conflict_table(key))
+
+
 def reachable(t2: Template, o2: Operation, p2: Operation, co2: Conn,
               tn: Template, on: Operation, pn: Operation, cpn: Conn,
-              h: int, rtc: nx.Graph) -> bool:
+              h: int, rtc: Reachability, conflicts: ConflictTable) -> bool:
     """Verify whether we can close the sequence loop from t2 to tn."""
     # Case 1: n = 2 => t2 = tn
     if t2 == tn and o2 == on and p2 == pn:
@@ -177,7 +397,7 @@ def reachable(t2: Template, o2: Operation, p2: Operation, co2: Conn,
             return True
 
     # Case 2: n = 3 => direct conflict between t2 and t3 = tn
-    if o2.is_conflicting(pn):
+    if conflicts.is_conflicting(o2, pn):
         # Connectedness correctly propagated
         if co2 == cpn:
             return True
@@ -186,43 +406,35 @@ def reachable(t2: Template, o2: Operation, p2: Operation, co2: Conn,
             return True
 
     # Case 3: n > 3 => Use transitive closure
-    # iterate over edges in rtc, and check compatibility with operations o2 and pn.
-    for nstart, nstop in rtc.edges:
-        if nstart.k == InOut.IN and nstop.k == InOut.OUT and \
-                nstart.operation.is_conflicting(o2) and nstop.operation.is_conflicting(pn) and \
-                nstart.conn == co2 and nstop.conn == cpn:
-            return True
-
-    return False
+    # look for an (IN, OUT) pair in rtc that is compatible with operations o2 and pn.
+    return rtc.connects(o2, co2, pn, cpn)
 
 
-def get_connectedness(target_op: Operation,
-                      o: Operation, co: Conn,
-                      p: Operation, cp: Conn,
-                      h: int) -> set[Conn]:
+def connectedness_mask(target_op: Operation,
+                       o: Operation, co: int,
+                       p: Operation, cp: int,
+                       h: int) -> int:
     """
-    Returns the set of connectedness options for the target operation in the provided template.
-    The incoming and outgoing operations o and p are provided, together with their connectedness.
+    Returns the connectedness options for the target operation in the provided template,
+    as Conn values or-ed together.
+    The incoming and outgoing operations o and p are provided, together with their connectedness co and cp.
     If h=1 (i.e., o and p are connected), the connectedness of the target operation is
     automatically extended to both Conn.O and Conn.P if at least one of both is included.
     """
-    result: set[Conn] = set()
+    result = 0
     if target_op.variable == o.variable:
-        result.add(co)
+        result |= co
     if target_op.variable == p.variable:
-        result.add(cp)
-    if len(result) == 0:
-        result = {Conn.N, }
+        result |= cp
+    if result == 0:
+        return CONN_N
 
-    if h == 1:
-        if Conn.O in result:
-            result.add(Conn.P)
-        if Conn.P in result:
-            result.add(Conn.O)
+    if h == 1 and result & (CONN_O | CONN_P):
+        result |= CONN_O | CONN_P
 
     # Some sanity checks
-    assert (h == 1 and result in [{Conn.N, }, {Conn.O, Conn.P}]) or \
-        (h == 2 and result in [{Conn.N, }, {Conn.O, }, {Conn.P, }])
+    assert (h == 1 and result in (CONN_N, CONN_O | CONN_P)) or \
+        (h == 2 and result in (CONN_N, CONN_O, CONN_P))
 
     return result
 
@@ -230,48 +442,38 @@ def get_connectedness(target_op: Operation,
 def is_valid_cycle(t1: Template, o1: Operation, p1: Operation,
                    t2: Template, o2: Operation, p2: Operation, co2: Conn,
                    tn: Template, on: Operation, pn: Operation, cpn: Conn,
-                   h: int, alloc: Allocation) -> bool:
+                   h: int, alloc: Allocation, conflicts: ConflictTable) -> bool:
     """
     Check whether the cycle is valid.
     Note that this only requires info about templates t1, t2, and tn
     """
-    # Condition (2) and (3): no ww conflict between prefix of t1 and either t2 or tn
-    # Furthermore, if t1 is under SI or SSI, no ww conflict between
-    # postfix of t1 and either t2 or tn
-    for op1 in t1.operations:
-        op1_conns = get_connectedness(op1, o1, Conn.O, p1, Conn.P, h)
-        # No need to check ww-conflicts if op1 is not connected to o1 and p1
-        if Conn.N not in op1_conns:
-            for op2 in t2.operations:
-                if op1.is_ww_conflicting(op2):
-                    op2_conns = get_connectedness(op2, o2, co2, p2, Conn.O, h)
-                    if len(op1_conns.intersection(op2_conns)) > 0:
-                        # Connected!
-                        return False
-            for opn in tn.operations:
-                if op1.is_ww_conflicting(opn):
-                    opn_conns = get_connectedness(opn, on, Conn.P, pn, cpn, h)
-                    if len(op1_conns.intersection(opn_conns)) > 0:
-                        # Connected!
-                        return False
-        if op1 == o1 and alloc.mapping[t1] == IsolationLevel.READ_COMMITTED:
-            # Only operations before or equal to o1 in t1 are considered
-            break
+    # The constant-time conditions (4), (5) and (6) are checked first,
+    # as they reject most cycles before any of the template scans.
+    return is_valid_cycle_ends(t1, o1, p1, t2, p2, tn, on, alloc, conflicts) and \
+        is_valid_cycle_connectedness(t1, o1, p1, t2, o2, p2, co2,
+                                     tn, on, pn, cpn, h, alloc, conflicts)
+
 
+def is_valid_cycle_ends(t1: Template, o1: Operation, p1: Operation,
+                        t2: Template, p2: Operation,
+                        tn: Template, on: Operation,
+                        alloc: Allocation, conflicts: ConflictTable) -> bool:
+    """
+    Check conditions (4), (5) and (6) of a valid cycle.
+    These do not depend on o2, pn or the connectedness options, so they are
+    shared by all cycles through (t1, o1, p1), (t2, p2) and (tn, on).
+    """
     # Condition (4)
-    if not o1.is_rw_conflicting(p2):
+    if not conflicts.is_rw_conflicting(o1, p2):
         return False
 
     # Condition (5)
-    if not on.is_rw_conflicting(p1):
+    if not conflicts.is_rw_conflicting(on, p1):
         if alloc.mapping[t1] != IsolationLevel.READ_COMMITTED:
             return False
-        for op in t1.operations:
-            # p1 occurs before o1 in t1
-            if op == p1:
-                return False
-            if op == o1:
-                break
+        # p1 occurs before o1 in t1
+        if p1 in t1.operations[:t1.operations.index(o1) + 1]:
+            return False
 
     # Condition (6)
     if alloc.mapping[t1] == IsolationLevel.SERIALIZABLE and \
@@ -279,92 +481,193 @@ def is_valid_cycle(t1: Template, o1: Operation, p1: Operation,
             alloc.mapping[tn] == IsolationLevel.SERIALIZABLE:
         return False
 
+    return True
+
+
+def is_valid_cycle_connectedness(t1: Template, o1: Operation, p1: Operation,
+                                 t2: Template, o2: Operation, p2: Operation, co2: Conn,
+                                 tn: Template, on: Operation, pn: Operation, cpn: Conn,
+                                 h: int, alloc: Allocation, conflicts: ConflictTable) -> bool:
+    """
+    Check conditions (2), (3), (7) and (8) of a valid cycle,
+    which depend on the connectedness of the operations in t1, t2, and tn.
+    Connectedness is handled as bitmasks (see connectedness_mask),
+    so that "connected" is a single and of two integers.
+    """
+    co2_mask = co2.value
+    cpn_mask = cpn.value
+    t1_conns = [(op1, connectedness_mask(op1, o1, CONN_O, p1, CONN_P, h)) for op1 in t1.operations]
+    t2_conns = [(op2, connectedness_mask(op2, o2, co2_mask, p2, CONN_O, h)) for op2 in t2.operations]
+    tn_conns = [(opn, connectedness_mask(opn, on, CONN_P, pn, cpn_mask, h)) for opn in tn.operations]
+
+    # Condition (2) and (3): no ww conflict between prefix of t1 and either t2 or tn
+    # Furthermore, if t1 is under SI or SSI, no ww conflict between
+    # postfix of t1 and either t2 or tn
+    if alloc.mapping[t1] == IsolationLevel.READ_COMMITTED:
+        # Only operations before or equal to o1 in t1 are considered
+        t1_ops = t1_conns[:t1.operations.index(o1) + 1]
+    else:
+        t1_ops = t1_conns
+    for op1, op1_conns in t1_ops:
+        # No need to check ww-conflicts if op1 is not connected to o1 and p1
+        if not op1_conns & CONN_N:
+            for op2, op2_conns in t2_conns:
+                if op1_conns & op2_conns and conflicts.is_ww_conflicting(op1, op2):
+                    # Connected!
+                    return False
+            for opn, opn_conns in tn_conns:
+                if op1_conns & opn_conns and conflicts.is_ww_conflicting(op1, opn):
+                    # Connected!
+                    return False
+
     # Condition (7)
     if alloc.mapping[t1] == IsolationLevel.SERIALIZABLE and \
             alloc.mapping[t2] == IsolationLevel.SERIALIZABLE:
-        for op1 in t1.operations:
-            op1_conns = get_connectedness(op1, o1, Conn.O, p1, Conn.P, h)
-            for op2 in t2.operations:
-                if op1.is_wr_conflicting(op2):
-                    op2_conns = get_connectedness(op2, o2, co2, p2, Conn.O, h)
-                    if len(op1_conns.intersection(op2_conns)) > 0:
-                        # Connected!
-                        return False
+        for op1, op1_conns in t1_conns:
+            for op2, op2_conns in t2_conns:
+                if op1_conns & op2_conns and conflicts.is_wr_conflicting(op1, op2):
+                    # Connected!
+                    return False
 
     # Condition (8)
     if alloc.mapping[t1] == IsolationLevel.SERIALIZABLE and \
             alloc.mapping[tn] == IsolationLevel.SERIALIZABLE:
-        for op1 in t1.operations:
-            op1_conns = get_connectedness(op1, o1, Conn.O, p1, Conn.P, h)
-            for opn in tn.operations:
-                if op1.is_rw_conflicting(opn):
-                    opn_conns = get_connectedness(opn, on, Conn.P, pn, cpn, h)
-                    if len(op1_conns.intersection(opn_conns)) > 0:
-                        # Connected!
-                        return False
+        for op1, op1_conns in t1_conns:
+            for opn, opn_conns in tn_conns:
+                if op1_conns & opn_conns and conflicts.is_rw_conflicting(op1, opn):
+                    # Connected!
+                    return False
 
     return True
 
 
-def is_robust(template_set: TemplateSet, alloc: Allocation) -> tuple[bool,dict]:
-    """Returns True if the set of templates is robust under the given allocation"""
-    template_ops = {(t, o, p) for t in template_set.templates for o, p in itertools.product(t.operations, repeat=2)}
-    for t1, o1, p1 in tqdm(template_ops):
-    #for t1 in template_set.templates:
-    #    for o1, p1 in tqdm(itertools.product(t1.operations, repeat=2)):
-        h_options = {1, } if o1.variable == p1.variable else {1, 2}
-        for h in h_options:
-            pt_graph = pt_conflict_graph(o1, p1, t1, h, template_set)
-            rtc = nx.transitive_closure(pt_graph, reflexive=True)
-            for t2, p2 in {(t, p) for t in template_set.templates for p in t.operations}:
-                if not o1.is_rw_conflicting(p2):
+def _find_cycle(key: frozenset[tuple[Template, tuple[Operation, ...]]], alloc: Allocation,
+                template_op: tuple[Template, Operation, Operation]) -> dict:
+    """
+    Search for a counterexample cycle starting in t1 with operations o1 and p1,
+    given as template_op = (t1, o1, p1), over the template set identified by key.
+    Returns the description of the first cycle found, or an empty dict if there is none.
+    """
+    t1, o1, p1 = template_op
+    conflicts = _conflict_table(key)
+    h_options = (1, ) if o1.variable == p1.variable else (1, 2)
+    for h in h_options:
+        rtc = _pt_closure(o1, p1, t1, h, key)
+        for t2, p2 in conflicts.rw_partners[o1]:
+            for tn, on in conflicts.conflicting_partners[p1]:
+                # Conditions shared by every (o2, pn, co2, cpn) completing the cycle
+                if not is_valid_cycle_ends(t1, o1, p1, t2, p2, tn, on, alloc, conflicts):
                     continue
                 for o2 in t2.operations:
-                    for tn, on in {(t, p) for t in template_set.templates for p in t.operations}:
-                        if not on.is_conflicting(p1):
-                            continue
-                        for pn in tn.operations:
-                            co2_options = {Conn.O, } if o2.variable == p2.variable else {
-                                Conn.N, Conn.P}
-                            cpn_options = {Conn.P, } if on.variable == pn.variable else {
-                                Conn.N, Conn.O}
-                            for co2, cpn in itertools.product(co2_options, cpn_options):
-                                if is_valid_cycle(t1, o1, p1, t2, o2, p2, co2,
-                                                        tn, on, pn, cpn, h, alloc) and \
-                                                            reachable(t2, o2, p2, co2, tn, on, pn, cpn, h, rtc):
-                                    return (False, {
-                                        "t1": t1,
-                                        "o1": o1,
-                                        "p1": p1,
-                                        "h": h,
-                                        "t2": t2,
-                                        "o2": o2,
-                                        "p2": p2,
-                                        "co2": co2,
-                                        "tn": tn,
-                                        "on": on,
-                                        "pn": pn,
-                                        "cpn": cpn
-                                    })
+                    co2_options = (Conn.O, ) if o2.variable == p2.variable else (Conn.N, Conn.P)
+                    for pn in tn.operations:
+                        cpn_options = (Conn.P, ) if on.variable == pn.variable else (Conn.N, Conn.O)
+                        for co2, cpn in itertools.product(co2_options, cpn_options):
+                            if is_valid_cycle_connectedness(t1, o1, p1, t2, o2, p2, co2,
+                                                            tn, on, pn, cpn, h, alloc, conflicts) and \
+                                    reachable(t2, o2, p2, co2, tn, on, pn, cpn, h, rtc, conflicts):
+                                return {
+                                    "t1": t1,
+                                    "o1": o1,
+                                    "p1": p1,
+                                    "h": h,
+                                    "t2": t2,
+                                    "o2": o2,
+                                    "p2": p2,
+                                    "co2": co2,
+                                    "tn": tn,
+                                    "on": on,
+                                    "pn": pn,
+                                    "cpn": cpn
+                                }
+    return {}
+
+
+def is_robust(template_set: TemplateSet, alloc: Allocation,
+              processes: int = 1) -> tuple[bool,dict]:
+    """
+    Returns True if the set of templates is robust under the given allocation.
+    The search for a counterexample is independent for every (t1, o1, p1), and is
+    spread over the given number of processes. The first counterexample found stops the search.
+    """
+    key = _template_set_key(template_set)
+    conflicts = _conflict_table(key)
+    # Only pairs where o1 has an rw-antidependency and p1 a conflict can start a cycle
+    template_ops = tuple(dict.fromkeys((t, o, p) for t in template_set.templates
+                                       for o, p in itertools.product(t.operations, repeat=2)
+                                       if conflicts.rw_partners[o] and conflicts.conflicting_partners[p]))
+    search = functools.partial(_find_cycle, key, alloc)
+    if processes == 1:
+        for template_op in tqdm(template_ops):
+            info = search(template_op)
+            if info:
+                return (False, info)
+        return (True, {})
+
+    # Build the shared closures up front: forked workers inherit them instead of each rebuilding them
+    for t1, o1, p1 in template_ops:
+        for h in ((1, ) if o1.variable == p1.variable else (1, 2)):
+            _pt_closure(o1, p1, t1, h, key)
+
+    # Leaving the with-block terminates the pool, cancelling the remaining searches
+    with multiprocessing.Pool(processes) as pool:
+        for info in tqdm(pool.imap_unordered(search, template_ops), total=len(template_ops)):
+            if info:
+                return (False, info)
     return (True, {})
 
 
-def optimal_alloc(template_set) -> Allocation:
-    """Returns the optimal robust allocation for the provided set of templates"""
+def cycle_still_witness(info: dict, alloc: Allocation) -> bool:
+    """
+    True iff the counterexample cycle described by info, as returned by is_robust,
+    is still a valid cycle under the given allocation.
+    Only this single cycle is checked, so this is much cheaper than a full robustness test.
+    """
+    key = _template_set_key(alloc.templateset)
+    conflicts = _conflict_table(key)
+    rtc = _pt_closure(info["o1"], info["p1"], info["t1"], info["h"], key)
+    return is_valid_cycle(info["t1"], info["o1"], info["p1"],
+                          info["t2"], info["o2"], info["p2"], info["co2"],
+                          info["tn"], info["on"], info["pn"], info["cpn"],
+                          info["h"], alloc, conflicts) and \
+        reachable(info["t2"], info["o2"], info["p2"], info["co2"],
+                  info["tn"], info["on"], info["pn"], info["cpn"], info["h"], rtc, conflicts)
+
+
+def _is_robust_with_witnesses(template_set: TemplateSet, alloc: Allocation,
+                              witnesses: list[dict], processes: int) -> bool:
+    """
+    Returns True if the set of templates is robust under the given allocation.
+    Counterexamples found earlier are re-checked first, and new ones are added to witnesses.
+    """
+    if any(cycle_still_witness(info, alloc) for info in witnesses):
+        return False
+    robust, info = is_robust(template_set, alloc, processes)
+    if not robust:
+        witnesses.append(info)
+    return robust
+
+
+def optimal_alloc(template_set, processes: int = 1) -> Allocation:
+    """
+    Returns the optimal robust allocation for the provided set of templates.
+    Each robustness test uses the given number of processes.
+    """
     alloc = Allocation(template_set,
                        {t: IsolationLevel.SERIALIZABLE for t in template_set.templates})
+    witnesses: list[dict] = []
 
     for t in template_set.templates:
         print(f"Processing template {t.name}")
         # Try SI
         alloc.mapping[t] = IsolationLevel.SNAPSHOT_ISOLATION
-        if not is_robust(template_set, alloc)[0]:
+        if not _is_robust_with_witnesses(template_set, alloc, witnesses, processes):
             # not robust -> revert
             alloc.mapping[t] = IsolationLevel.SERIALIZABLE
         else:
             # robust -> Try RC
             alloc.mapping[t] = IsolationLevel.READ_COMMITTED
-            if not is_robust(template_set, alloc)[0]:
+            if not _is_robust_with_witnesses(template_set, alloc, witnesses, processes):
                 # Not robust -> revert
                 alloc.mapping[t] = IsolationLevel.SNAPSHOT_ISOLATION
     return alloc
@@ -1,11 +1,52 @@
 """File that specifies the protocol for the Benchmarks"""
+import functools
 import random
+from array import array
 from abc import abstractmethod
-from typing import Optional, Protocol
+from typing import Any, Optional, Protocol
 from dataclasses import dataclass
 import psycopg2 as pg
 
 
+class AliasSampler:
+    """
+    Samples index i with probability weights[i] / sum(weights) in constant time,
+    using the alias method of Walker (in the construction of Vose).
+    """
+    def __init__(self, weights: list[float]):
+        n = len(weights)
+        total = sum(weights)
+        prob = [w * n / total for w in weights]
+        alias = [0] * n
+        small = [i for i, p in enumerate(prob) if p < 1]
+        large = [i for i, p in enumerate(prob) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            alias[less] = more
+            prob[more] += prob[less] - 1
+            if prob[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # Only rounding errors are left over
+        for i in small + large:
+            prob[i] = 1.0
+        self.size = n
+        self.prob = array("d", prob)
+        self.alias = array("l", alias)
+
+    def sample(self) -> int:
+        """Sample an index"""
+        i = int(random.random() * self.size)
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+@functools.lru_cache(maxsize=None)
+def zipfian_sampler(skew: float, n: int) -> AliasSampler:
+    """Sampler over the zipfian weights of the values 1..n (as indices 0..n-1), built once per (skew, n)"""
+    return AliasSampler([1 / (i+1)**skew for i in range(n)])
+
+
 @dataclass
 class TransactionResult:
     """Dataclass collecting the result of running a transaction"""
@@ -29,10 +70,16 @@ class Benchmark(Protocol):
                      config_dict: dict,
                      conn: pg.extensions.connection,
                      process_id: Optional[int] = None,
-                     logfile: Optional[str] = None) -> TransactionResult:
-        """Runs a transaction in the benchmark based on the given config file"""
+                     log_writer: Optional[Any] = None) -> TransactionResult:
+        """
+        Runs a transaction in the benchmark based on the given config file.
+        If given, a row describing the transaction is written to the csv log_writer.
+        """
         raise NotImplementedError
 
+    def prepare_connection(self, conn: pg.extensions.connection):
+        """Prepares a client connection before it runs transactions, e.g. by preparing statements"""
+
     @abstractmethod
     def check_config(self, config_dict: dict):
         """Checks if the config file is valid for the benchmark"""
@@ -45,13 +92,9 @@ class Benchmark(Protocol):
 
     def zipfian(self, skew: float, n: int) -> int:
         """Sample an account from the database by the zipfian sampling method"""
-        s: float = 0.0
-        for i in range(n):
-            s += 1 / (i+1)**skew
-        value = random.random() * s
-        s = 0.0
-        for i in range(n):
-            s += 1 / (i+1)**skew
-            if s > value:
-                return i+1
-        return n
+        return zipfian_sampler(skew, n).sample() + 1
+
+    def zipfian_batch(self, skew: float, n: int, size: int) -> list[int]:
+        """Sample size accounts from the database by the zipfian sampling method at once"""
+        sample = zipfian_sampler(skew, n).sample
+        return [sample() + 1 for _ in range(size)]
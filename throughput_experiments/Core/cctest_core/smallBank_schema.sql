@@ -22,4 +22,108 @@ CREATE TABLE Checking (
     CONSTRAINT fk_customer
         FOREIGN KEY(CustomerID)
         REFERENCES Account(CustomerID)
-);
\ No newline at end of file
+);
+-- The programs run as server-side functions, so that every program is a single round-trip.
+-- The functions are VOLATILE, so every statement still takes its own snapshot under READ COMMITTED.
+
+CREATE OR REPLACE FUNCTION smallbank_deposit_checking(account_name VARCHAR, amount FLOAT)
+RETURNS VOID AS $$
+BEGIN
+    UPDATE Checking SET Balance = Balance + amount
+    WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION smallbank_transact_savings(account_name VARCHAR, amount FLOAT)
+RETURNS VOID AS $$
+BEGIN
+    UPDATE Savings SET Balance = Balance + amount
+    WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION smallbank_balance(account_name VARCHAR,
+                                             promote_savings BOOLEAN, promote_checking BOOLEAN)
+RETURNS FLOAT AS $$
+DECLARE
+    customer INT;
+    savings_balance FLOAT;
+    checking_balance FLOAT;
+BEGIN
+    IF promote_savings THEN
+        SELECT CustomerId, Balance INTO customer, savings_balance FROM Savings
+        WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name)
+        FOR UPDATE;
+    ELSE
+        SELECT CustomerId, Balance INTO customer, savings_balance FROM Savings
+        WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name);
+    END IF;
+
+    IF promote_checking THEN
+        SELECT Balance INTO checking_balance FROM Checking WHERE CustomerId = customer FOR UPDATE;
+    ELSE
+        SELECT Balance INTO checking_balance FROM Checking WHERE CustomerId = customer;
+    END IF;
+
+    RETURN savings_balance + checking_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION smallbank_amalgamate(account_name1 VARCHAR, account_name2 VARCHAR)
+RETURNS VOID AS $$
+DECLARE
+    customer INT;
+    savings_balance FLOAT;
+    checking_balance FLOAT;
+BEGIN
+    UPDATE Savings as new
+    SET Balance = 0
+    FROM Savings as old
+    WHERE new.CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name1)
+            AND old.CustomerId = new.CustomerId
+    RETURNING old.Balance INTO savings_balance;
+
+    UPDATE Checking as new
+    SET Balance = 0
+    FROM Checking as old
+    WHERE new.CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name2)
+            AND old.CustomerId = new.CustomerId
+    RETURNING old.Balance, new.CustomerId INTO checking_balance, customer;
+
+    UPDATE Checking
+    SET Balance = Balance + savings_balance + checking_balance
+    WHERE CustomerId = customer;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION smallbank_write_check(account_name VARCHAR, amount FLOAT,
+                                                 promote_savings BOOLEAN, promote_checking BOOLEAN)
+RETURNS VOID AS $$
+DECLARE
+    customer INT;
+    savings_balance FLOAT;
+    checking_balance FLOAT;
+BEGIN
+    IF promote_savings THEN
+        SELECT CustomerId, Balance INTO customer, savings_balance FROM Savings
+        WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name)
+        FOR UPDATE;
+    ELSE
+        SELECT CustomerId, Balance INTO customer, savings_balance FROM Savings
+        WHERE CustomerId = (SELECT CustomerId FROM Account WHERE Name = account_name);
+    END IF;
+
+    IF promote_checking THEN
+        SELECT Balance INTO checking_balance FROM Checking WHERE CustomerId = customer FOR UPDATE;
+    ELSE
+        SELECT Balance INTO checking_balance FROM Checking WHERE CustomerId = customer;
+    END IF;
+
+    IF checking_balance + savings_balance < amount THEN
+        -- Overdraft penalty
+        UPDATE Checking SET Balance = Balance - (amount + 1) WHERE CustomerId = customer;
+    ELSE
+        UPDATE Checking SET Balance = Balance - amount WHERE CustomerId = customer;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
@@ -1,14 +1,14 @@
 """File that contains the code for the smallBank experiment"""
+import io
 import json
 import random
-import csv
 from importlib.resources import files
 from typing import Optional, Any
-from time import time
+from time import perf_counter_ns, time
 import psycopg2 as pg
 from jsonschema import SchemaError, ValidationError, validate
-from psycopg2 import sql
-from cctest_core.protocol import Benchmark, TransactionResult
+from psycopg2 import errorcodes
+from cctest_core.protocol import AliasSampler, Benchmark, TransactionResult
 
 P_DEPOSIT_CHECKING = "depositChecking"
 P_BALANCE = "balance"
@@ -24,15 +24,43 @@ PROGRAMS = [
     P_WRITE_CHECK
 ]
 
+# Calls to the server-side functions of the programs (see the schema), prepared once on every client connection
+PREPARED_STATEMENTS = {
+    "deposit_checking": "(VARCHAR, FLOAT) AS SELECT smallbank_deposit_checking($1, $2)",
+    "balance": "(VARCHAR, BOOLEAN, BOOLEAN) AS SELECT smallbank_balance($1, $2, $3)",
+    "transact_savings": "(VARCHAR, FLOAT) AS SELECT smallbank_transact_savings($1, $2)",
+    "amalgamate": "(VARCHAR, VARCHAR) AS SELECT smallbank_amalgamate($1, $2)",
+    "write_check": "(VARCHAR, FLOAT, BOOLEAN, BOOLEAN) AS SELECT smallbank_write_check($1, $2, $3, $4)"
+}
+
+ISOLATION_LEVELS = {
+    "RC": pg.extensions.ISOLATION_LEVEL_READ_COMMITTED,
+    "SI": pg.extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+    "SSI": pg.extensions.ISOLATION_LEVEL_SERIALIZABLE
+}
+
+ACCOUNT_BATCH_SIZE = 10000
+
 class SmallBank(Benchmark):
     """Class that contains the code for the smallBank experiment"""
     def __init__(self):
         self.url = None
         self.hotspot = []
         self.config_dict = {}
+        self.schema_created = False
+        self.account_samples: list[int] = []
+        self.cursors: dict[pg.extensions.connection, pg.extensions.cursor] = {}
+        self.program_sampler: Optional[AliasSampler] = None
+        self.program_isolation_levels: dict[str, str] = {}
+        self.sampling_method = None
+        self.num_accounts = 0
+        self.zipfian_skew = None
+        self.hotspot_size = None
+        self.hotspot_probability = None
 
     def init_db(self, config_dict):
         self.config_dict = config_dict
+        self._load_program_config(config_dict["smallBank"])
         username = config_dict["dbUsername"]
         password = config_dict["dbPassword"]
         host = config_dict["dbUrl"]
@@ -47,31 +75,29 @@ class SmallBank(Benchmark):
             sql_schema = schema.read()
             try:
                 with conn.cursor() as cursor:
-                    cursor.execute(sql_schema)
-                    conn.commit()
-                    print("[Smallbank] Database schema created")
-
+                    # The schema is only created for the first run, later runs empty the tables instead
+                    if not self.schema_created:
+                        cursor.execute(sql_schema)
+                        conn.commit()
+                        self.schema_created = True
+                        print("[Smallbank] Database schema created")
+                    else:
+                        cursor.execute("TRUNCATE Account, Checking, Savings")
+
+                    accounts, checkings, savings = [], [], []
                     for i in range(config_dict["smallBank"]["numberOfAccounts"]):
-                        name = "name" + str(i+1)
-                        cursor.execute(
-                            sql.SQL("""INSERT INTO account (name, CustomerId)
-                                    VALUES (%s, %s) 
-                                    RETURNING CustomerID"""), (name, i)
-                        )
-
-                        customer_id = cursor.fetchone()
-                        if customer_id is not None:
-                            customer_id = customer_id[0]
-
-                        cursor.execute(
-                            sql.SQL("""INSERT INTO Checking (CustomerId, Balance)
-                                    VALUES (%s, %s)"""), (customer_id, random.randint(100, 10000))
-                        )
-
-                        cursor.execute(
-                            sql.SQL("""INSERT INTO Savings (CustomerId, Balance)
-                                    VALUES (%s, %s)"""), (customer_id, random.randint(100, 10000))
-                        )
+                        accounts.append(f"name{i+1},{i}\n")
+                        checkings.append(f"{i},{random.randint(100, 10000)}\n")
+                        savings.append(f"{i},{random.randint(100, 10000)}\n")
+
+                    # The database is recreated on failure anyway, so there is no need to wait for the WAL flush
+                    cursor.execute("SET LOCAL synchronous_commit = OFF")
+                    cursor.copy_expert("COPY Account (name, CustomerId) FROM STDIN WITH (FORMAT csv)",
+                                       io.StringIO("".join(accounts)))
+                    cursor.copy_expert("COPY Checking (CustomerId, Balance) FROM STDIN WITH (FORMAT csv)",
+                                       io.StringIO("".join(checkings)))
+                    cursor.copy_expert("COPY Savings (CustomerId, Balance) FROM STDIN WITH (FORMAT csv)",
+                                       io.StringIO("".join(savings)))
                     conn.commit()
                     print("[Smallbank] Database instance created")
 
@@ -82,81 +108,78 @@ class SmallBank(Benchmark):
                 conn.close()
 
 
-    def _set_read_committed(self, conn):
-        """Set the isolation level to read committed"""
-        conn.set_session(isolation_level=pg.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-
-
-    def _set_snapshot_isolation(self, conn):
-        conn.set_session(isolation_level=pg.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
-
-
-    def _set_serializable(self, conn):
-        conn.set_session(isolation_level=pg.extensions.ISOLATION_LEVEL_SERIALIZABLE)
-
-
     def _set_isolation_level(self, conn, isolation_level):
-        if isolation_level == "RC":
-            self._set_read_committed(conn)
-        elif isolation_level == "SI":
-            self._set_snapshot_isolation(conn)
-        elif isolation_level == "SSI":
-            self._set_serializable(conn)
-        else:
+        if isolation_level not in ISOLATION_LEVELS:
             raise ValueError(f"Unknown isolation level: {isolation_level}")
-
-    def _sample_account(self, sb_config_dict: dict) -> int:
-        """Sample an account number from the database by the given sampling method"""
-        sampling_method = sb_config_dict["accountSamplingMethod"]
-        num_accounts = sb_config_dict["numberOfAccounts"]
-        if sampling_method == "zipfian":
-            skew = sb_config_dict["zipfianSkew"]
-            return self.zipfian(skew, num_accounts)
-        if sampling_method == "hotspot":
-            hotspot_size = sb_config_dict["hotspotSize"]
-            hotspot_probability = sb_config_dict["hotspotProbability"]
-            if random.random() < hotspot_probability:
-                return random.randint(1, hotspot_size)
-            return random.randint(hotspot_size + 1, num_accounts)
-        raise ValueError(f"Unknown sampling method: {sampling_method}")
-
-    def _sample_program(self, sb_config_dict: dict) -> str:
-        weights = [
+        # The connection remembers its isolation level, so only change it when it differs
+        level = ISOLATION_LEVELS[isolation_level]
+        if conn.isolation_level != level:
+            conn.set_session(isolation_level=level)
+
+    def _load_program_config(self, sb_config_dict: dict):
+        """Reads the sampling parameters and isolation levels of the programs from the config once"""
+        self.program_sampler = AliasSampler([
             sb_config_dict["programDepositCheckingSamplingWeight"],
             sb_config_dict["programBalanceSamplingWeight"],
             sb_config_dict["programTransactSavingsSamplingWeight"],
             sb_config_dict["programAmalgamateSamplingWeight"],
             sb_config_dict["programWriteCheckSamplingWeight"]
-        ]
-
+        ])
+        self.program_isolation_levels = {
+            P_DEPOSIT_CHECKING: sb_config_dict["programDepositCheckingAllocatedIsolationLevel"],
+            P_BALANCE: sb_config_dict["programBalanceAllocatedIsolationLevel"],
+            P_TRANSACT_SAVINGS: sb_config_dict["programTransactSavingsAllocatedIsolationLevel"],
+            P_AMALGAMATE: sb_config_dict["programAmalgamateAllocatedIsolationLevel"],
+            P_WRITE_CHECK: sb_config_dict["programWriteCheckAllocatedIsolationLevel"]
+        }
+        self.sampling_method = sb_config_dict["accountSamplingMethod"]
+        self.num_accounts = sb_config_dict["numberOfAccounts"]
+        self.zipfian_skew = sb_config_dict.get("zipfianSkew")
+        self.hotspot_size = sb_config_dict.get("hotspotSize")
+        self.hotspot_probability = sb_config_dict.get("hotspotProbability")
+        self.account_samples = []
+
+    def _sample_accounts(self, size: int) -> list[int]:
+        """Sample size account numbers from the database at once by the configured sampling method"""
+        if self.sampling_method == "zipfian":
+            return self.zipfian_batch(self.zipfian_skew, self.num_accounts, size)
+        if self.sampling_method == "hotspot":
+            hotspot_size = self.hotspot_size
+            other_size = self.num_accounts - hotspot_size
+            return [int(random.random() * hotspot_size) + 1
+                    if random.random() < self.hotspot_probability
+                    else int(random.random() * other_size) + hotspot_size + 1
+                    for _ in range(size)]
+        raise ValueError(f"Unknown sampling method: {self.sampling_method}")
+
+    def _sample_account(self) -> int:
+        """Sample an account number from the database by the configured sampling method"""
+        # Accounts are sampled in batches, and handed out one by one
+        if not self.account_samples:
+            self.account_samples = self._sample_accounts(ACCOUNT_BATCH_SIZE)
+        return self.account_samples.pop()
+
+    def _sample_program(self) -> str:
         # random selection based on weights
-        return random.choices(PROGRAMS, weights, k=1)[0]
+        return PROGRAMS[self.program_sampler.sample()]
 
-    def _get_program_isolation_level(self, sb_config_dict: dict, program: str) -> str:
+    def _get_program_isolation_level(self, program: str) -> str:
         """Returns the configured isolation level for the given program"""
-        if program == P_DEPOSIT_CHECKING:
-            return sb_config_dict["programDepositCheckingAllocatedIsolationLevel"]
-        if program == P_BALANCE:
-            return sb_config_dict["programBalanceAllocatedIsolationLevel"]
-        if program == P_TRANSACT_SAVINGS:
-            return sb_config_dict["programTransactSavingsAllocatedIsolationLevel"]
-        if program == P_AMALGAMATE:
-            return sb_config_dict["programAmalgamateAllocatedIsolationLevel"]
-        if program == P_WRITE_CHECK:
-            return sb_config_dict["programWriteCheckAllocatedIsolationLevel"]
-        raise ValueError(f"Unknown program: {program}")
+        if program not in self.program_isolation_levels:
+            raise ValueError(f"Unknown program: {program}")
+        return self.program_isolation_levels[program]
 
     def _run_transact_once(self,
                            conn: pg.extensions.connection,
                            sb_config_dict: dict,
                            program: str,
-                           accounts: tuple[int, int]) -> Optional[Any]:
+                           accounts: tuple[int, Optional[int]]) -> Optional[Any]:
         """
         Run the specified transaction, once.
         The return value is None if the transaction committed successfully,
         or the error object if aborted.
         """
-        level = self._get_program_isolation_level(sb_config_dict, program)
+        level = self._get_program_isolation_level(program)
         self._set_isolation_level(conn, level)
         if program == P_DEPOSIT_CHECKING:
             name = "name" + str(accounts[0])
@@ -184,28 +207,38 @@ class SmallBank(Benchmark):
                      config_dict: dict,
                      conn: pg.extensions.connection,
                      process_id: Optional[int] = None,
-                     logfile: Optional[str] = None) -> TransactionResult:
+                     log_writer: Optional[Any] = None) -> TransactionResult:
         """Runs a transaction in the benchmark based on the given config file"""
+        # The values derived from the config are only (re)loaded when a different config is given
+        if config_dict is not self.config_dict:
+            self.config_dict = config_dict
+            self._load_program_config(config_dict["smallBank"])
         sb_config_dict = config_dict["smallBank"]
-        program = self._sample_program(sb_config_dict)
-        level = self._get_program_isolation_level(sb_config_dict, program)
-        account_1 = self._sample_account(sb_config_dict)
-        account_2 = self._sample_account(sb_config_dict)
-        while account_1 == account_2:
-            account_2 = self._sample_account(sb_config_dict)
+        program = self._sample_program()
+        level = self._get_program_isolation_level(program)
+        account_1 = self._sample_account()
+        # Only amalgamate uses a second, distinct, account
+        account_2 = None
+        if program == P_AMALGAMATE:
+            account_2 = self._sample_account()
+            while account_1 == account_2:
+                account_2 = self._sample_account()
         accounts = (account_1, account_2)
 
         tres = TransactionResult(program, level)
-        start = time()
+        start_ns = perf_counter_ns()
         while(True):
             result = self._run_transact_once(conn, sb_config_dict, program, accounts)
             if result is not None:
-                # an abort occurred
-                if isinstance(result, pg.errors.DeadlockDetected): # pylint: disable=no-member
+                # an abort occurred, classified by its SQLSTATE
+                code = getattr(result, "pgcode", None)
+                if code == errorcodes.DEADLOCK_DETECTED:
                     tres.num_deadlock_abort += 1
-                elif isinstance(result, pg.errors.SerializationFailure) and "concurrent update" in str(result): # pylint: disable=no-member
+                elif code == errorcodes.SERIALIZATION_FAILURE and \
+                        "concurrent update" in result.diag.message_primary:
                     tres.num_conc_abort += 1
-                elif isinstance(result, pg.errors.SerializationFailure) and "pivot" in str(result): # pylint: disable=no-member
+                elif code == errorcodes.SERIALIZATION_FAILURE and \
+                        "pivot" in (result.diag.message_detail or ""):
                     tres.num_serial_abort += 1
                 else:
                     print(f"Unknown abort reason: {result}")
@@ -213,12 +246,12 @@ class SmallBank(Benchmark):
                 # Successful commit
                 break
 
-        end = time()
-        tres.total_time = end - start
-        if logfile is not None:
-            with open(logfile, "a", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow(["", tres.num_deadlock_abort, tres.num_conc_abort,
+        tres.total_time = (perf_counter_ns() - start_ns) / 1_000_000_000
+        if log_writer is not None:
+            # The log holds wall clock timestamps, the duration itself is measured monotonically
+            end = time()
+            start = end - tres.total_time
+            log_writer.writerow(["", tres.num_deadlock_abort, tres.num_conc_abort,
                                  tres.num_serial_abort, start, end, tres.total_time, process_id])
 
         return tres
@@ -239,21 +272,24 @@ class SmallBank(Benchmark):
                 print("Invalid config file")
 
 
+    def _cursor(self, conn):
+        """Returns the cursor of the given connection, which is created once and then reused"""
+        if conn not in self.cursors:
+            self.cursors[conn] = conn.cursor()
+        return self.cursors[conn]
+
+    def prepare_connection(self, conn):
+        """Prepare the statements of the programs on the given connection"""
+        with conn.cursor() as cursor:
+            for name, statement in PREPARED_STATEMENTS.items():
+                cursor.execute(f"PREPARE {name} {statement}")
+        conn.commit()
+
     def deposit_checking(self, name, value, conn):
         """Add the given value to the checking account"""
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name,)
-            )
-
-            customer_id = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("UPDATE Checking SET Balance = Balance + %s WHERE CustomerId = %s"),
-                (value, customer_id)
-            )
+            cursor = self._cursor(conn)
+            cursor.execute("EXECUTE deposit_checking (%s, %s)", (name, value))
 
             conn.commit()
         except Exception as e:
@@ -264,40 +300,11 @@ class SmallBank(Benchmark):
     def balance(self, name, promotion, conn):
         """Return the total balance of the checking and savings account"""
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name,)
-            )
-
-            customer_id = cursor.fetchone()[0]
-
-
-            if "Savings" in promotion:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Savings WHERE CustomerId = %s FOR UPDATE"),
-                    (customer_id,)
-                )
-            else:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Savings WHERE CustomerId = %s"),
-                    (customer_id,)
-                )
-
-            balance = cursor.fetchone()[0]
-
-            if "Checking" in promotion:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Checking WHERE CustomerId = %s FOR UPDATE"),
-                    (customer_id,)
-                )
-            else:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Checking WHERE CustomerId = %s"),
-                    (customer_id,)
-                )
+            cursor = self._cursor(conn)
+            cursor.execute("EXECUTE balance (%s, %s, %s)",
+                           (name, "Savings" in promotion, "Checking" in promotion))
 
-            balance += cursor.fetchone()[0]
+            cursor.fetchone()
             
             conn.commit()
         except Exception as e:
@@ -309,18 +316,8 @@ class SmallBank(Benchmark):
     def transact_savings(self, name, value, conn):
         """Add the given value to the savings account"""
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name,)
-            )
-
-            customer_id = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("UPDATE Savings SET Balance = Balance + %s WHERE CustomerId = %s"),
-                (value, customer_id)
-            )
+            cursor = self._cursor(conn)
+            cursor.execute("EXECUTE transact_savings (%s, %s)", (name, value))
 
             conn.commit()
         except Exception as e:
@@ -331,53 +328,8 @@ class SmallBank(Benchmark):
     def amalgamate(self, name1, name2, conn):
         """Move all the money from the savings account of name1 to the checking account of name2"""
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name1,)
-            )
-
-            customer_id1 = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name2,)
-            )
-
-            customer_id2 = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("""
-                    UPDATE Savings as new 
-                    SET Balance = 0
-                    FROM Savings as old
-                    WHERE new.CustomerId = %s 
-                            AND old.CustomerId = new.CustomerId
-                    RETURNING old.Balance """),
-                    (customer_id1,)
-            )
-
-            balance1 = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("""
-                    UPDATE Checking as new 
-                    SET Balance = 0
-                    FROM Checking as old
-                    WHERE new.CustomerId = %s 
-                            AND old.CustomerId = new.CustomerId
-                    RETURNING old.Balance """),
-                    (customer_id2,)
-            )
-
-            balance2 = cursor.fetchone()[0]
-
-            cursor.execute(
-                sql.SQL("""UPDATE Checking
-                                SET Balance = Balance + %s + %s
-                                WHERE CustomerId = %s"""),
-                                (balance1, balance2, customer_id2)
-            )
+            cursor = self._cursor(conn)
+            cursor.execute("EXECUTE amalgamate (%s, %s)", (name1, name2))
 
             conn.commit()
         except Exception as e:
@@ -388,55 +340,9 @@ class SmallBank(Benchmark):
     def write_check(self, name, value, promotion, conn):
         """Write a check for the given value"""
         try:
-            cursor = conn.cursor()
-            cursor.execute(
-                sql.SQL("SELECT CustomerId FROM Account WHERE Name = %s"),
-                (name,)
-            )
-
-            customer_id = cursor.fetchone()[0]
-
-            if "Savings" in promotion:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Savings WHERE CustomerId = %s FOR UPDATE"),
-                    (customer_id,)
-                )
-            else:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Savings WHERE CustomerId = %s"),
-                    (customer_id,)
-                )
-
-            balance_savings = cursor.fetchone()[0]
-
-
-            if "Checking" in promotion:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Checking WHERE CustomerId = %s FOR UPDATE"),
-                    (customer_id,)
-                )
-            else:
-                cursor.execute(
-                    sql.SQL("SELECT Balance FROM Checking WHERE CustomerId = %s"),
-                    (customer_id,)
-                )
-
-            balance_checking = cursor.fetchone()[0]
-
-            if balance_checking + balance_savings < value:
-                cursor.execute(
-                    sql.SQL("""UPDATE Checking
-                                    SET Balance = Balance - (%s + 1)
-                                    WHERE CustomerId = %s"""),
-                                    (value, customer_id)
-                )
-            else:
-                cursor.execute(
-                    sql.SQL("""UPDATE Checking
-                                    SET Balance = Balance - %s
-                                    WHERE CustomerId = %s"""),
-                                    (value, customer_id)
-                )
+            cursor = self._cursor(conn)
+            cursor.execute("EXECUTE write_check (%s, %s, %s, %s)",
+                           (name, value, "Savings" in promotion, "Checking" in promotion))
 
             conn.commit()
         except Exception as e:
@@ -1,18 +1,24 @@
 """This file is used to run the expirement"""
 import argparse
+import contextlib
 import csv
 import os
 import json
-from multiprocessing import Process, Barrier, Queue
+from multiprocessing import Process, Barrier, SimpleQueue
+from multiprocessing.connection import wait
 import multiprocessing.synchronize as mps
 import time
 import sys
+import traceback
 from typing import Optional
 from dataclasses import dataclass, field
 import psycopg2 as pg
 from cctest_core.protocol import Benchmark
 from cctest_core.benchmarks import get_benchmark
 
+# Seconds between the liveness checks of the clients while waiting for their results
+CLIENT_CHECK_INTERVAL = 1
+
 @dataclass
 class ProgramResult:
     """Stores the cumulative results for a specific program"""
@@ -23,6 +29,14 @@ class ProgramResult:
     num_conc_abort: int = 0
     num_serial_abort: int = 0
 
+    def merge(self, other: "ProgramResult") -> None:
+        """Adds the counters of another result for the same program to this one"""
+        self.total_completed += other.total_completed
+        self.total_time += other.total_time
+        self.num_deadlock_abort += other.num_deadlock_abort
+        self.num_conc_abort += other.num_conc_abort
+        self.num_serial_abort += other.num_serial_abort
+
 
 @dataclass
 class ClientResult:
@@ -34,6 +48,26 @@ class ClientResult:
     num_serial_abort: int = 0
     programs: dict[str, ProgramResult] = field(default_factory=dict)
 
+    def merge(self, other: "ClientResult") -> None:
+        """Adds the counters of another client result to this one"""
+        self.total_completed += other.total_completed
+        for il, num in other.total_il_completed.items():
+            self.total_il_completed[il] = self.total_il_completed.get(il, 0) + num
+        self.num_deadlock_abort += other.num_deadlock_abort
+        self.num_conc_abort += other.num_conc_abort
+        self.num_serial_abort += other.num_serial_abort
+        for prgn, prgres in other.programs.items():
+            if prgn not in self.programs:
+                self.programs[prgn] = ProgramResult(isolation_level=prgres.isolation_level)
+            self.programs[prgn].merge(prgres)
+
+
+@dataclass
+class ClientFailure:
+    """Put on the result queue instead of a result by a client process that failed"""
+    process_id: int
+    error: str
+
 
 def read_config_file(filename):
     """Reads the config file and returns a dictionary"""
@@ -48,48 +82,73 @@ def write_results(filename, results):
         json.dump(results, result_file, indent=4)
 
 
-def start_processes(config_dict, benchmark_param: Benchmark, superrun: int, run: int, logfile=None):
-    """Starts the processes for the benchmark"""
-    processes = []
+def start_clients(config_dict, benchmark_param: Benchmark) -> tuple[list[Process], SimpleQueue, SimpleQueue]:
+    """
+    Starts the client processes, which are reused for all runs.
+    Returns the processes, the queue to send run commands on and the queue the results arrive on.
+    """
     barrier = Barrier(config_dict["concurrentClients"])
-
+    commands = SimpleQueue()
+    queue = SimpleQueue()
+    processes = []
+    for i in range(config_dict["concurrentClients"]):
+        processes.append(Process(target=run_client,
+                                    args=(config_dict, benchmark_param,
+                                        barrier, commands, queue, i)))
+        processes[i].start()
+    return processes, commands, queue
+
+
+def stop_clients(processes: list[Process], commands: SimpleQueue):
+    """Stops the client processes"""
+    for _ in processes:
+        commands.put(None)
+    for process in processes:
+        process.join()
+
+
+def terminate_clients(processes: list[Process]):
+    """Terminates the client processes, e.g. after a failed run"""
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+
+
+def get_client_result(processes: list[Process], queue: SimpleQueue):
+    """Waits for the next client result, and raises an error when a client exited instead"""
+    while queue.empty():
+        # The clients only exit when stopped, so an exit during a run means it failed
+        if wait([process.sentinel for process in processes], timeout=CLIENT_CHECK_INTERVAL) \
+                and queue.empty():
+            exited = [process for process in processes if not process.is_alive()]
+            raise RuntimeError("Client process(es) exited during the run with exit code(s) "
+                               f"{[process.exitcode for process in exited]}")
+    result = queue.get()
+    if isinstance(result, ClientFailure):
+        raise RuntimeError(f"Client process {result.process_id} failed:\n{result.error}")
+    return result
+
+
+def run_clients(config_dict, benchmark_param: Benchmark, processes: list[Process],
+                commands: SimpleQueue, queue: SimpleQueue, superrun: int, run: int, logfile=None):
+    """Runs the benchmark once on all client processes"""
     if logfile is not None:
         # Prepare a subfolder for this superrun and run
         logfile = f"{logfile}/logs_{config_dict['experimentName']}/run_{superrun}_{run}"
         # Create folder if not existing
         os.makedirs(os.path.dirname(logfile + "/"), exist_ok=True)
 
-    queue = Queue()
-
-    for i in range(config_dict["concurrentClients"]):
-        processes.append(Process(target=run_benchmark,
-                                    args=(config_dict, benchmark_param,
-                                        barrier, queue, i, logfile)))
-        processes[i].start()
-    for i in range(config_dict["concurrentClients"]):
-        processes[i].join()
+    # Every client takes exactly one command: none of them passes the start barrier
+    # of the run before all of them took one. Each client then puts exactly one result.
+    for _ in range(config_dict["concurrentClients"]):
+        commands.put((logfile,))
+    client_results = [get_client_result(processes, queue) for _ in range(config_dict["concurrentClients"])]
 
     # First collect all results in a single result object for convenience.
     res = ClientResult()
-    while not queue.empty():
-        cr = queue.get()
-        res.total_completed += cr.total_completed
-        for il, num in cr.total_il_completed.items():
-            if il not in res.total_il_completed:
-                res.total_il_completed[il] = 0
-            res.total_il_completed[il] += num
-        res.num_deadlock_abort += cr.num_deadlock_abort
-        res.num_conc_abort += cr.num_conc_abort
-        res.num_serial_abort += cr.num_serial_abort
-        for prgn, prgres in cr.programs.items():
-            if prgn not in res.programs:
-                res.programs[prgn] = ProgramResult(isolation_level=prgres.isolation_level)
-            res_prgres = res.programs[prgn]
-            res_prgres.total_completed += prgres.total_completed
-            res_prgres.total_time += prgres.total_time
-            res_prgres.num_deadlock_abort += prgres.num_deadlock_abort
-            res_prgres.num_conc_abort += prgres.num_conc_abort
-            res_prgres.num_serial_abort += prgres.num_serial_abort
+    for cr in client_results:
+        res.merge(cr)
 
     # Construct the expected result dict
     results = {}
@@ -139,87 +198,109 @@ def generate_pg_connection_url(config_dict: dict) -> str:
     database = config_dict["dbName"]
     return f"postgresql://{username}:{password}@{host}:{port}/{database}"
 
-def run_benchmark(config_dict: dict, benchmark: Benchmark, barrier: mps.Barrier,
-                  queue: Queue, process_id: int, logfile: Optional[str]) -> None:
-    """Runs the benchmark"""
-    connection = pg.connect(generate_pg_connection_url(config_dict))
+def run_client(config_dict: dict, benchmark: Benchmark, barrier: mps.Barrier,
+               commands: SimpleQueue, queue: SimpleQueue, process_id: int) -> None:
+    """
+    Runs a client process: its connection is set up once,
+    after which it runs the benchmark for every command until it receives None.
+    When it fails, a ClientFailure is put on the queue instead of a result and the client exits.
+    """
+    connection = None
+    try:
+        connection = pg.connect(generate_pg_connection_url(config_dict))
+
+        # set session parameters
+        cursor = connection.cursor()
+        cursor.execute("SET enable_seqscan = OFF;")
+        if not config_dict.get("synchronousCommit", True):
+            # Commits no longer wait for the WAL flush: trades crash durability for throughput
+            cursor.execute("SET synchronous_commit = OFF;")
+        connection.commit()
+        benchmark.prepare_connection(connection)
+
+        while (command := commands.get()) is not None:
+            logfile, = command
+            queue.put(run_benchmark(config_dict, benchmark, barrier, connection, process_id, logfile))
+    except Exception: # pylint: disable=broad-exception-caught
+        queue.put(ClientFailure(process_id, traceback.format_exc()))
+    finally:
+        if connection is not None:
+            connection.close()
 
-    if logfile is not None:
-        # The logfile is unique for each client process
-        logfile = f"{logfile}/{process_id}.csv"
-
-        with open(logfile, "w", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow(["Process_id", "Timestamp", "Program", "Account", "Event", "#RC error", "#SI error", "#SSI error", "Start", "End", "Duration"])
-
-    # set session parameters
-    cursor = connection.cursor()
-    cursor.execute("SET enable_seqscan = OFF;")
-    connection.commit()
-
-    # Results object to collect results locally
-    results = ClientResult()
-
-    # Wait until all processes are ready
-    barrier.wait()
-
-    # Warmup phase: run transactions without recording results
-    start_warmup = time.time()
-
-    if logfile is not None:
-        with open(logfile, "a", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow([process_id, start_warmup, "", "", "Info-Warmup", 0, 0, 0, 0, 0, 0, 0])
-
-    while int(time.time() - start_warmup) < int(config_dict["timing"]["warmup"]):
-        benchmark.run_transact(config_dict, connection, process_id, logfile)
-    # print("Warmup done")
 
-    # Experiment phase: run transactions and record results
-    start_experiment = time.time()
-
-    if logfile is not None:
-        with open(logfile, "a", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow([process_id, start_experiment, "", "", "Info-Start", 0, 0, 0, 0, 0, 0, 0])
-
-    while int(time.time() - start_experiment) < int(config_dict["timing"]["experiment"]):
-        tres = benchmark.run_transact(config_dict, connection, process_id, logfile)
-
-        # Store results locally
-        results.total_completed += 1
-        il = tres.isolation_level
-        if il not in results.total_il_completed:
-            results.total_il_completed[il] = 0
-        results.total_il_completed[il] += 1
-        results.num_deadlock_abort += tres.num_deadlock_abort
-        results.num_conc_abort += tres.num_conc_abort
-        results.num_serial_abort += tres.num_serial_abort
-        if tres.program_name not in results.programs:
-            results.programs[tres.program_name] = ProgramResult(isolation_level=il)
-        prgres = results.programs[tres.program_name]
-        prgres.total_completed += 1
-        prgres.total_time += tres.total_time
-        prgres.num_deadlock_abort += tres.num_deadlock_abort
-        prgres.num_conc_abort += tres.num_conc_abort
-        prgres.num_serial_abort += tres.num_serial_abort
-
-    # Cooldown phase: run transactions without recording results
-    start_cooldown = time.time()
-
-    if logfile is not None:
-        with open(logfile, "a", encoding="utf-8") as file:
-            writer = csv.writer(file)
-            writer.writerow([process_id, start_cooldown, "", "", "Info-Cooldown", 0, 0, 0, 0, 0, 0, 0])
-
-    while int(time.time() - start_cooldown) < int(config_dict["timing"]["extraTime"]):
-        benchmark.run_transact(config_dict, connection, process_id, logfile)
-    # print("Cooldown done")
-
-    connection.close()
+def run_benchmark(config_dict: dict, benchmark: Benchmark, barrier: mps.Barrier,
+                  connection: pg.extensions.connection, process_id: int,
+                  logfile: Optional[str]) -> ClientResult:
+    """Runs the benchmark once, on the given connection"""
+    # The logfile is unique for each client process, and is kept open during the whole run
+    with contextlib.ExitStack() as stack:
+        log_file = None
+        log_writer = None
+        if logfile is not None:
+            log_file = stack.enter_context(open(f"{logfile}/{process_id}.csv", "w", encoding="utf-8"))
+            log_writer = csv.writer(log_file)
+            log_writer.writerow(["Process_id", "Timestamp", "Program", "Account", "Event", "#RC error", "#SI error", "#SSI error", "Start", "End", "Duration"])
+
+        # Results object to collect results locally
+        results = ClientResult()
+
+        # Wait until all processes are ready
+        barrier.wait()
+
+        # Warmup phase: run transactions without recording results
+        start_warmup = time.time()
+        end_warmup = time.perf_counter_ns() + int(config_dict["timing"]["warmup"]) * 1_000_000_000
+
+        if log_file is not None:
+            log_writer.writerow([process_id, start_warmup, "", "", "Info-Warmup", 0, 0, 0, 0, 0, 0, 0])
+            log_file.flush()
+
+        while time.perf_counter_ns() < end_warmup:
+            benchmark.run_transact(config_dict, connection, process_id, log_writer)
+        # print("Warmup done")
+
+        # Experiment phase: run transactions and record results
+        start_experiment = time.time()
+        end_experiment = time.perf_counter_ns() + int(config_dict["timing"]["experiment"]) * 1_000_000_000
+
+        if log_file is not None:
+            log_writer.writerow([process_id, start_experiment, "", "", "Info-Start", 0, 0, 0, 0, 0, 0, 0])
+            log_file.flush()
+
+        while time.perf_counter_ns() < end_experiment:
+            tres = benchmark.run_transact(config_dict, connection, process_id, log_writer)
+
+            # Store results locally
+            results.total_completed += 1
+            il = tres.isolation_level
+            if il not in results.total_il_completed:
+                results.total_il_completed[il] = 0
+            results.total_il_completed[il] += 1
+            results.num_deadlock_abort += tres.num_deadlock_abort
+            results.num_conc_abort += tres.num_conc_abort
+            results.num_serial_abort += tres.num_serial_abort
+            if tres.program_name not in results.programs:
+                results.programs[tres.program_name] = ProgramResult(isolation_level=il)
+            prgres = results.programs[tres.program_name]
+            prgres.total_completed += 1
+            prgres.total_time += tres.total_time
+            prgres.num_deadlock_abort += tres.num_deadlock_abort
+            prgres.num_conc_abort += tres.num_conc_abort
+            prgres.num_serial_abort += tres.num_serial_abort
+
+        # Cooldown phase: run transactions without recording results
+        start_cooldown = time.time()
+        end_cooldown = time.perf_counter_ns() + int(config_dict["timing"]["extraTime"]) * 1_000_000_000
+
+        if log_file is not None:
+            log_writer.writerow([process_id, start_cooldown, "", "", "Info-Cooldown", 0, 0, 0, 0, 0, 0, 0])
+            log_file.flush()
+
+        while time.perf_counter_ns() < end_cooldown:
+            benchmark.run_transact(config_dict, connection, process_id, log_writer)
+        # print("Cooldown done")
 
-    # Store results in the queue
-    queue.put(results)
+    return results
 
 
 def main():
@@ -242,20 +323,33 @@ def main():
     benchmark.check_config(config)
     results_superruns = {"superruns" : [],
                             "config" : config}
-    for superrun in range(config["numberOfSuperruns"]):
-        results_runs = {"runs" : []}
-        for run in range(config["numberOfRuns"]):
-            print(f"Superrun {superrun+1} of {config['numberOfSuperruns']}, run {run+1} of {config['numberOfRuns']}")
-            benchmark.init_db(config)
-            print("DB initialized!")
-            # Wait a couple of seconds to avoid interference between database creation and the experiment
-            #print("Waiting 2 seconds before starting the next run after creating the DB instance")
-            time.sleep(2)
-            print("Starting processes")
-            result = start_processes(config, benchmark, superrun, run, args.log)
-            print("Processes done")
-            results_runs["runs"].append(result)
-        results_superruns["superruns"].append(results_runs)
+    # The clients are started once the database exists, and are reused for all runs
+    clients = None
+    try:
+        for superrun in range(config["numberOfSuperruns"]):
+            results_runs = {"runs" : []}
+            for run in range(config["numberOfRuns"]):
+                print(f"Superrun {superrun+1} of {config['numberOfSuperruns']}, run {run+1} of {config['numberOfRuns']}")
+                benchmark.init_db(config)
+                print("DB initialized!")
+                # Wait a couple of seconds to avoid interference between database creation and the experiment
+                #print("Waiting 2 seconds before starting the next run after creating the DB instance")
+                time.sleep(2)
+                if clients is None:
+                    print("Starting processes")
+                    clients = start_clients(config, benchmark)
+                result = run_clients(config, benchmark, *clients, superrun, run, args.log)
+                print("Run done")
+                results_runs["runs"].append(result)
+            results_superruns["superruns"].append(results_runs)
+    except BaseException:
+        # The remaining clients may wait on the barrier or a command forever
+        if clients is not None:
+            terminate_clients(clients[0])
+        raise
+    if clients is not None:
+        processes, commands, _ = clients
+        stop_clients(processes, commands)
     write_results(sys.argv[2], results_superruns)
 
 